@@ -1,141 +1,372 @@
 import os
 import time
-import requests
-import urllib3
+import asyncio
+import aiohttp
 from duckduckgo_search import DDGS
 from urllib.parse import urlparse
-import mimetypes
 import hashlib
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from threading import Lock
-
-
-urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
-
-def create_session():
-    session = requests.Session()
-    session.headers.update({
-        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64)"
-    })
-    return session
-
-def get_extension_from_url_or_content(url, response):
-    path = urlparse(url).path
-    ext = os.path.splitext(path)[1]
-    if ext and len(ext) <= 5:
-        return ext.lstrip(".")
-    content_type = response.headers.get("content-type", "").split(";")[0]
-    guessed = mimetypes.guess_extension(content_type)
-    if guessed:
-        return guessed.lstrip(".")
-    return "jpg"
-
-def download_image(url, folder, person_name, seen_hashes, session, bad_domains, lock, max_retries=3):
-    parsed = urlparse(url)
-    if parsed.netloc in bad_domains:
-        return None
+import contextlib
+import tempfile
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 
-    for attempt in range(max_retries):
-        try:
-            response = session.get(url, stream=True, timeout=(5, 15), verify=False)
-            if response.status_code == 200 and response.headers.get("content-type", "").startswith("image"):
-                img_bytes = response.content
-                img_hash = hashlib.md5(img_bytes).hexdigest()
+try:
+    from blake3 import blake3
+except ImportError:
+    blake3 = None
+
+try:
+    from pybloom_live import ScalableBloomFilter
+except ImportError:
+    ScalableBloomFilter = None
+
+try:
+    import diskcache
+except ImportError:
+    diskcache = None
+
+try:
+    # crop_faces.py (repo root) must be importable, e.g. via PYTHONPATH, to crop while downloading
+    from crop_faces import crop_image_bytes, FACE_DETECTOR_MODEL_PATH, MAX_WORKERS as CROP_WORKERS
+except ImportError:
+    crop_image_bytes = None
+
+
+BAD_DOMAIN_MAX_FAILURES = 5  # Consecutive failed downloads before a host is skipped
+MAX_CONNECTIONS_PER_HOST = 6  # Keep per-host load polite even with many downloads in flight
+DOWNLOAD_RETRIES = 3
+RETRY_BACKOFF_FACTOR = 0.5  # Seconds; doubles after each failed attempt
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+MIN_IMAGE_BYTES = 5_000  # Smaller bodies are icons / tracking pixels
+MAX_IMAGE_BYTES = 10_000_000  # Larger bodies are huge TIFFs/scans the face cropper rejects anyway
+IMAGE_HEADER_BYTES = 12  # Enough to match every signature below (WebP needs bytes 8-12)
+IMAGE_SIGNATURES = (
+    (b"\xff\xd8\xff", "jpg"),
+    (b"\x89PNG\r\n\x1a\n", "png"),
+    (b"GIF8", "gif"),
+    (b"BM", "bmp"),
+    (b"II*\x00", "tiff"),
+    (b"MM\x00*", "tiff"),
+)
+# Mode a plain open(path, "wb") would give; temp files are created 0600, so apply it before renaming
+_umask = os.umask(0)
+os.umask(_umask)
+SAVED_FILE_MODE = 0o666 & ~_umask
+SEARCH_SAFESEARCH = "Off"
+SEARCH_SIZE = "Large"
+DDGS_CACHE_DIR = ".ddgs_cache"
+DDGS_CACHE_TTL = 7 * 24 * 3600  # Seconds before cached search results are fetched again
+
+# Keyword -> image URL cache shared by every run, opened on first use by get_ddgs_cache
+_ddgs_cache = None
+_ddgs_cache_opened = False
+
+def create_session(threads=50):
+    # One connection pool for the whole run; ssl=False matches the old verify=False behaviour
+    connector = aiohttp.TCPConnector(limit=threads * 2, limit_per_host=MAX_CONNECTIONS_PER_HOST, ssl=False)
+    return aiohttp.ClientSession(
+        connector=connector,
+        headers={"User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64)"},
+        timeout=aiohttp.ClientTimeout(sock_connect=5, sock_read=15),
+    )
 
-                with lock:
-                    if img_hash in seen_hashes:
+def new_image_hasher():
+    # 128-bit digest (digest()[:16]) is plenty for dedup; BLAKE3 is much faster than MD5, blake2b is the stdlib fallback
+    if blake3 is not None:
+        return blake3()
+    return hashlib.blake2b(digest_size=16)
+
+def new_seen_hashes():
+    # A scalable Bloom filter keeps dedup at a few bytes per image for any number of batches; plain set without pybloom_live
+    if ScalableBloomFilter is not None:
+        return ScalableBloomFilter(initial_capacity=100_000, error_rate=1e-7)
+    return set()
+
+def get_image_extension(header):
+    # Identify the format from the file's magic bytes instead of trusting the server's content-type
+    for signature, ext in IMAGE_SIGNATURES:
+        if header.startswith(signature):
+            return ext
+    if header[:4] == b"RIFF" and header[8:12] == b"WEBP":
+        return "webp"
+    return None
+
+async def download_image(url, path_prefix, seen_hashes, session, bad_domains, semaphore, host_semaphores, face_pool=None, crop_semaphore=None):
+    if crop_semaphore is None:
+        return await _download_image(url, path_prefix, seen_hashes, session, bad_domains, semaphore, host_semaphores, face_pool)
+    # When cropping, each body stays in memory until its crop finishes; taking a crop slot
+    # before downloading caps that at the semaphore's size instead of the whole batch
+    async with crop_semaphore:
+        return await _download_image(url, path_prefix, seen_hashes, session, bad_domains, semaphore, host_semaphores, face_pool)
+
+async def _download_image(url, path_prefix, seen_hashes, session, bad_domains, semaphore, host_semaphores, face_pool):
+    # Runs on the event loop thread only, so seen_hashes and bad_domains need no lock.
+    # With a face_pool, the image is cropped in memory and only the face is written.
+    # Files are saved as f"{path_prefix}{digest}.{ext}" (path_prefix is "<folder>/<Name>_").
+    parsed = urlparse(url)
+    # Wait for a slot on this host before taking a global one, so downloads queued behind a
+    # busy host (aiohttp allows MAX_CONNECTIONS_PER_HOST connections) don't tie up global slots
+    host_slot = host_semaphores.get(parsed.netloc)
+    if host_slot is None:
+        host_slot = host_semaphores[parsed.netloc] = asyncio.Semaphore(MAX_CONNECTIONS_PER_HOST)
+
+    tmp_path = None
+    img_bytes = None
+    crop_digest = None
+    try:
+        # Retry connection errors and throttling/server errors with exponential backoff. The host
+        # slot is held across retries (backing off a struggling host also holds back its queue,
+        # so its failures add up and later downloads get skipped); the global slot is only
+        # held per attempt, so backoff sleeps don't starve other hosts
+        async with host_slot:
+            for attempt in range(DOWNLOAD_RETRIES + 1):
+                async with semaphore:
+                    # Checked once a slot is free, so failures earlier in the batch skip the rest of a dead host
+                    if bad_domains.get(parsed.netloc, 0) >= BAD_DOMAIN_MAX_FAILURES:
                         return None
-                    seen_hashes.add(img_hash)
 
-                ext = get_extension_from_url_or_content(url, response)
-                file_path = os.path.join(folder, f"{person_name.replace(' ', '_')}_{img_hash}.{ext}")
-                with open(file_path, "wb") as f:
-                    f.write(img_bytes)
-                return file_path
+                    last_attempt = attempt == DOWNLOAD_RETRIES
+                    try:
+                        response = await session.get(url)
+                    except (aiohttp.ClientError, asyncio.TimeoutError):
+                        if last_attempt:
+                            raise
+                        response = None
+
+                    if response is not None and (response.status not in RETRY_STATUSES or last_attempt):
+                        async with response:
+                            ext = None
+                            if response.status == 200:
+                                # Skip bodies outside the size bounds before downloading them (when the server sends a length)
+                                size = response.content_length
+                                if size is not None and not MIN_IMAGE_BYTES <= size <= MAX_IMAGE_BYTES:
+                                    return None
+
+                                # Only keep bodies that start with a known image signature (catches HTML error pages)
+                                header = await response.content.readexactly(IMAGE_HEADER_BYTES)
+                                ext = get_image_extension(header)
+
+                            if ext is not None:
+                                # Hash while streaming to a temp file (memory when cropping) instead of buffering response.content
+                                hasher = new_image_hasher()
+                                hasher.update(header)
+                                if face_pool is None:
+                                    sink = tempfile.NamedTemporaryFile(dir=os.path.dirname(path_prefix), suffix=".part", delete=False)
+                                    tmp_path = sink.name
+                                    write = sink.write
+                                else:
+                                    # Cropping decodes from memory, so keep the body in a bytearray and skip the raw file
+                                    img_bytes = bytearray()
+                                    sink = contextlib.nullcontext()
+                                    write = img_bytes.extend
+                                with sink:
+                                    write(header)
+                                    size = len(header)
+                                    async for chunk in response.content.iter_chunked(65536):
+                                        size += len(chunk)
+                                        if size > MAX_IMAGE_BYTES:
+                                            return None
+                                        hasher.update(chunk)
+                                        write(chunk)
+                                if size < MIN_IMAGE_BYTES:
+                                    return None
+                                img_digest = hasher.digest()[:16]
+
+                                bad_domains.pop(parsed.netloc, None)
+                                if img_digest in seen_hashes:
+                                    return None
+                                seen_hashes.add(img_digest)
+
+                                if face_pool is not None:
+                                    # Crop below, after the download slot and connection are released
+                                    crop_digest = img_digest
+                                else:
+                                    file_path = f"{path_prefix}{img_digest.hex()}.{ext}"
+                                    os.chmod(tmp_path, SAVED_FILE_MODE)
+                                    os.replace(tmp_path, file_path)
+                                    tmp_path = None
+                                    return file_path
+                        break
+                    if response is not None:
+                        response.release()
+                await asyncio.sleep(RETRY_BACKOFF_FACTOR * 2 ** attempt)
+    except (aiohttp.ClientError, asyncio.TimeoutError, asyncio.IncompleteReadError, OSError):
+        # Network errors and truncated bodies count as a host failure below; anything
+        # else propagates to the "[!] Error in download" print in download_images_async
+        pass
+    finally:
+        # Also covers duplicates and downloads cancelled once the target count is reached
+        if tmp_path and os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+
+    if crop_digest is not None:
+        try:
+            _, face_jpeg = await asyncio.get_running_loop().run_in_executor(face_pool, crop_image_bytes, img_bytes)
         except Exception as e:
-            time.sleep(2)  
+            # A crop failure says nothing about the host, so it doesn't count towards bad_domains
+            print(f"[!] Face crop failed for {url}: {e}")
+            return None
+        if face_jpeg is None:
+            return None
+        file_path = f"{path_prefix}{crop_digest.hex()}.jpg"
+        with open(file_path, "wb") as f:
+            f.write(face_jpeg)
+        return file_path
 
-    bad_domains.add(parsed.netloc)
+    bad_domains[parsed.netloc] = bad_domains.get(parsed.netloc, 0) + 1
     return None
 
-def fetch_image_urls(keyword, total_needed, seen_urls, retries=3):
+def search_image_urls(keyword, max_results, safesearch=SEARCH_SAFESEARCH, size=SEARCH_SIZE, retries=3):
     for attempt in range(retries):
         try:
             with DDGS() as ddgs:
-                results = ddgs.images(keywords=keyword, max_results=total_needed*5, safesearch="Off", size="Large")
-                urls = []
-                for r in results:
-                    url = r.get("image")
-                    if url and url not in seen_urls:
-                        seen_urls.add(url)
-                        urls.append(url)
-                    if len(urls) >= total_needed:
-                        break
-                return urls
+                results = ddgs.images(keywords=keyword, max_results=max_results, safesearch=safesearch, size=size)
+                return [r["image"] for r in results if r.get("image")]
         except Exception as e:
             print(f"[!] DuckDuckGo failed on attempt {attempt+1}/{retries}: {e}")
             time.sleep(5)
     return []
 
-def download_images(search_terms, save_name, num_images=1000, save_folder="images", threads=10, batch_size=300, pause_time=60):
-    folder = os.path.join(save_folder, save_name.replace(" ", "_"))
+def get_ddgs_cache():
+    # Returns None (cache disabled) without diskcache or if the cache directory can't be opened
+    global _ddgs_cache, _ddgs_cache_opened
+    if not _ddgs_cache_opened:
+        _ddgs_cache_opened = True
+        if diskcache is not None:
+            try:
+                _ddgs_cache = diskcache.Cache(DDGS_CACHE_DIR)
+            except Exception as e:
+                print(f"[!] Search cache disabled, could not open '{DDGS_CACHE_DIR}': {e}")
+    return _ddgs_cache
+
+def fetch_image_urls(keyword, total_needed, seen_urls, retries=3):
+    # Search results are cached on disk so re-runs skip the rate-limited DDGS round-trip.
+    # Entries store the max_results they were fetched with; a larger request searches again.
+    max_results = total_needed*5
+    cache = get_ddgs_cache()
+    safesearch, size = SEARCH_SAFESEARCH, SEARCH_SIZE
+    cache_key = (keyword, safesearch, size)
+    cached = cache.get(cache_key) if cache is not None else None
+    if cached is not None and cached[0] >= max_results:
+        all_urls = cached[1]
+    else:
+        all_urls = search_image_urls(keyword, max_results, safesearch=safesearch, size=size, retries=retries)
+        if all_urls and cache is not None:
+            cache.set(cache_key, (max_results, all_urls), expire=DDGS_CACHE_TTL)
+
+    urls = []
+    for url in all_urls:
+        if url not in seen_urls:
+            seen_urls.add(url)
+            urls.append(url)
+        if len(urls) >= total_needed:
+            break
+    return urls
+
+def download_images(search_terms, save_name, num_images=1000, save_folder="images", threads=50, batch_size=300, pause_time=60, crop_faces=False):
+    asyncio.run(download_images_async(search_terms, save_name, num_images, save_folder, threads, batch_size, pause_time, crop_faces))
+
+async def download_images_async(search_terms, save_name, num_images=1000, save_folder="images", threads=50, batch_size=300, pause_time=60, crop_faces=False):
+    safe_name = save_name.replace(" ", "_")
+    folder = os.path.join(save_folder, safe_name)
     os.makedirs(folder, exist_ok=True)
+    path_prefix = os.path.join(folder, safe_name + "_")  # Built once; each file appends its digest
+
+    # crop_faces: detect and crop faces right after each download (in worker processes)
+    # and save only the cropped face, instead of the raw image for crop_faces.py to re-read
+    face_pool = None
+    crop_semaphore = None
+    if crop_faces:
+        if crop_image_bytes is None:
+            raise ImportError("crop_faces=True needs crop_faces.py (and OpenCV/numpy) to be importable")
+        if not os.path.exists(FACE_DETECTOR_MODEL_PATH):
+            raise FileNotFoundError(f"Face detector model not found at '{FACE_DETECTOR_MODEL_PATH}'")
+        # spawn, not fork: workers start lazily while the default executor may be running a
+        # DDGS search, and forking a multi-threaded process can deadlock the children
+        face_pool = ProcessPoolExecutor(max_workers=CROP_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+        # Bounds how many downloaded bodies can wait in memory for the pool
+        crop_semaphore = asyncio.Semaphore(2 * CROP_WORKERS)
 
-    session = create_session()
-    seen_hashes = set()
+    loop = asyncio.get_running_loop()
+    semaphore = asyncio.Semaphore(threads)  # Max downloads in flight
+    seen_hashes = new_seen_hashes()
     seen_urls = set()
-    bad_domains = set()
-    lock = Lock()
+    bad_domains = {}  # netloc -> consecutive failure count
+    host_semaphores = {}  # netloc -> asyncio.Semaphore(MAX_CONNECTIONS_PER_HOST)
     downloaded_count = 0
     batch_number = 0
     term_index = 0
 
     print(f"\n🔍 Starting download of {num_images} images for: {save_name}")
 
-    while downloaded_count < num_images:
-        keyword = search_terms[term_index % len(search_terms)]
-        remaining = num_images - downloaded_count
-        batch = min(batch_size, remaining)
-        print(f"\n🚀 Batch {batch_number + 1}: Searching for '{keyword}' to fetch {batch} images...")
-
-        image_urls = fetch_image_urls(keyword, batch, seen_urls)
-        if not image_urls:
-            print(f"❌ No more results for '{keyword}'. Trying next keyword...")
-            term_index += 1
-            if term_index >= len(search_terms):
-                print("🛑 All search terms exhausted.")
-                break
-            continue
-
-        with ThreadPoolExecutor(max_workers=threads) as executor:
-            future_to_url = {
-                executor.submit(download_image, url, folder, save_name, seen_hashes, session, bad_domains, lock): url
-                for url in image_urls
-            }
-
-            for future in as_completed(future_to_url):
-                try:
-                    result = future.result(timeout=30)
-                    if result:
-                        downloaded_count += 1
-                        print(f"✅ Downloaded [{downloaded_count}/{num_images}] → {os.path.basename(result)}")
-                    if downloaded_count >= num_images:
+    # DDGS is blocking, so searches run in the default thread pool; the next batch's
+    # URLs are prefetched there while the current batch downloads
+    prefetch = None
+
+    try:
+        async with create_session(threads) as session:
+            while downloaded_count < num_images:
+                keyword = search_terms[term_index % len(search_terms)]
+                remaining = num_images - downloaded_count
+                batch = min(batch_size, remaining)
+                print(f"\n🚀 Batch {batch_number + 1}: Searching for '{keyword}' to fetch {batch} images...")
+
+                if prefetch is not None:
+                    image_urls = await prefetch
+                    prefetch = None
+                else:
+                    image_urls = await loop.run_in_executor(None, fetch_image_urls, keyword, batch, seen_urls)
+                if not image_urls:
+                    print(f"❌ No more results for '{keyword}'. Trying next keyword...")
+                    term_index += 1
+                    if term_index >= len(search_terms):
+                        print("🛑 All search terms exhausted.")
                         break
-                except Exception as e:
-                    print(f"[!] Error in thread: {e}")
+                    continue
+
+                # Memory control: Limit set size (before the prefetch below starts adding to seen_urls)
+                if len(seen_urls) > 50000:
+                    seen_urls = set(list(seen_urls)[-25000:])
+
+                # Start the next search before queuing downloads so it runs alongside the whole batch.
+                # Skip it when this batch alone can reach the target: a running search can't be
+                # cancelled, and asyncio.run would wait on it (and spend a rate-limited query) at exit.
+                if batch < remaining:
+                    next_keyword = search_terms[(term_index + 1) % len(search_terms)]
+                    prefetch = loop.run_in_executor(None, fetch_image_urls, next_keyword, batch, seen_urls)
+
+                tasks = [
+                    asyncio.ensure_future(download_image(url, path_prefix, seen_hashes, session, bad_domains, semaphore, host_semaphores, face_pool, crop_semaphore))
+                    for url in image_urls
+                ]
+
+                for next_done in asyncio.as_completed(tasks):
+                    try:
+                        result = await next_done
+                        if result:
+                            downloaded_count += 1
+                            print(f"✅ Downloaded [{downloaded_count}/{num_images}] → {os.path.basename(result)}")
+                        if downloaded_count >= num_images:
+                            break
+                    except Exception as e:
+                        print(f"[!] Error in download: {e}")
 
-        batch_number += 1
-        term_index += 1
+                # Drop downloads still in flight once the target is reached
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
 
-        # Memory control: Limit set size
-        if len(seen_urls) > 50000:
-            seen_urls = set(list(seen_urls)[-25000:])
-        if len(seen_hashes) > 50000:
-            seen_hashes = set(list(seen_hashes)[-25000:])
+                batch_number += 1
+                term_index += 1
 
-        if downloaded_count < num_images:
-            print("🕐 Taking a 60-second break before next batch...\n")
-            time.sleep(pause_time)
+                if downloaded_count < num_images:
+                    print("🕐 Taking a 60-second break before next batch...\n")
+                    await asyncio.sleep(pause_time)
+    finally:
+        if prefetch is not None:
+            prefetch.cancel()
+        if face_pool is not None:
+            face_pool.shutdown(wait=True, cancel_futures=True)
 
     print(f"\n🎉 Done! Downloaded {downloaded_count} images of '{save_name}' to → {folder}")
 
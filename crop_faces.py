@@ -1,154 +1,272 @@
 import cv2
+import io
+import numpy as np
 import os
 import sys
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from PIL import Image, ImageOps
+
+try:
+    from turbojpeg import TurboJPEG
+except ImportError:
+    TurboJPEG = None
 
 # --- Configuration ---
 INPUT_BASE_DIR = 'images'  # Directory containing celebrity folders
 OUTPUT_BASE_DIR = 'cropped_pics' # Directory where cropped faces will be saved
-HAAR_CASCADE_PATH = 'haarcascade_frontalface_default.xml' # Path to the downloaded Haar Cascade file
+FACE_DETECTOR_MODEL_PATH = 'face_detection_yunet_2023mar.onnx' # Path to the downloaded YuNet ONNX model
+DETECTION_SIZE = 320 # Longest side (pixels) images are downscaled to for detection
+SCORE_THRESHOLD = 0.9 # Minimum detector confidence for a face
 TARGET_SIZE = (224, 224) # Desired output size (width, height) for cropped faces
 PADDING_FACTOR = 0.2 
 MIN_FACE_SIZE = (30, 30) # Minimum size of face to detect (helps filter noise)
 SAVE_JPEG_QUALITY = 95 # Quality for saving JPEG images (0-100, higher is better)
+VALID_EXTS = frozenset({'.png', '.jpg', '.jpeg', '.bmp', '.tiff'}) # Image file extensions to process
+MAX_WORKERS = os.cpu_count() # Number of worker processes used for cropping
 
 
+# Loaded once per process by _init_worker (the detector can't be pickled)
+face_detector = None
+jpeg_encoder = None # libjpeg-turbo encoder, None falls back to OpenCV's encoder
 
-# Check if Haar Cascade file exists
-if not os.path.exists(HAAR_CASCADE_PATH):
-    print(f"Error: Haar Cascade file not found at '{HAAR_CASCADE_PATH}'")
-    print("Please download it from OpenCV's GitHub repository and place it correctly.")
-    sys.exit(1)
 
-# Load the Haar Cascade classifier
-face_cascade = cv2.CascadeClassifier(HAAR_CASCADE_PATH)
-if face_cascade.empty():
-    print(f"Error: Could not load Haar Cascade classifier from '{HAAR_CASCADE_PATH}'")
-    sys.exit(1)
+def _create_detector():
+    return cv2.FaceDetectorYN.create(FACE_DETECTOR_MODEL_PATH, "", (DETECTION_SIZE, DETECTION_SIZE), SCORE_THRESHOLD)
 
-# Check if input directory exists
-if not os.path.isdir(INPUT_BASE_DIR):
-    print(f"Error: Input directory '{INPUT_BASE_DIR}' not found.")
-    sys.exit(1)
 
-# Create the base output directory if it doesn't exist
-if not os.path.exists(OUTPUT_BASE_DIR):
-    print(f"Creating output directory: '{OUTPUT_BASE_DIR}'")
-    os.makedirs(OUTPUT_BASE_DIR)
+def _init_worker():
+    global face_detector, jpeg_encoder
+    # Parallelism comes from the process pool; keep OpenCV to one thread per worker
+    # so N processes don't each spawn N threads
+    cv2.setNumThreads(1)
+    face_detector = _create_detector()
+    if TurboJPEG is not None:
+        try:
+            jpeg_encoder = TurboJPEG()
+        except (OSError, RuntimeError):
+            # PyTurboJPEG is installed but the libturbojpeg shared library isn't
+            jpeg_encoder = None
 
-print("Starting face detection and cropping process...")
-print(f"Input Directory:  {os.path.abspath(INPUT_BASE_DIR)}")
-print(f"Output Directory: {os.path.abspath(OUTPUT_BASE_DIR)}")
-print(f"Target Size:      {TARGET_SIZE}")
-print("-" * 30)
 
-# --- Processing ---
-skipped_no_face = 0
-skipped_multi_face = 0
-processed_count = 0
-error_count = 0
+def crop_face(buf, name):
+    """
+    Detects the largest face in an encoded image buffer (uint8 array), crops and resizes it.
+    Returns (status, resized_face): status is 'processed', 'multi_face' (largest face kept),
+    'no_face' or 'error', and resized_face is None unless a face was cropped.
+    """
+    # Detection runs on a reduced decode and the full-size color image is only
+    # decoded when a face is found. Pillow's JPEG draft mode decodes straight at
+    # the smallest DCT scale (1/2 to 1/8) that still covers DETECTION_SIZE.
+    try:
+        pil_image = Image.open(io.BytesIO(buf))
+        full_w = pil_image.size[0]
+        pil_image.draft('RGB', (DETECTION_SIZE, DETECTION_SIZE))
+        pil_image.load()
+        decode_ratio = full_w / pil_image.size[0]
+        # Match cv2.imdecode, which applies the EXIF orientation
+        pil_image = ImageOps.exif_transpose(pil_image)
+        small_image = np.ascontiguousarray(np.asarray(pil_image.convert('RGB'))[:, :, ::-1])  # RGB -> BGR for the detector
+    except (OSError, ValueError):
+        print(f"  Warning: Could not read image: {name}. Skipping.")
+        return 'error', None
 
-# Iterate through each celebrity folder in the input directory
-for celebrity_name in os.listdir(INPUT_BASE_DIR):
-    input_celebrity_dir = os.path.join(INPUT_BASE_DIR, celebrity_name)
-    output_celebrity_dir = os.path.join(OUTPUT_BASE_DIR, celebrity_name)
+    small_h, small_w = small_image.shape[:2]
 
-    # Ensure it's actually a directory
-    if not os.path.isdir(input_celebrity_dir):
-        continue
+    # Downscale so the longest side is at most DETECTION_SIZE before running the detector
+    scale = min(1.0, DETECTION_SIZE / max(small_h, small_w))
+    if scale < 1.0:
+        detect_image = cv2.resize(small_image, (max(1, int(small_w * scale)), max(1, int(small_h * scale))), interpolation=cv2.INTER_AREA)
+    else:
+        detect_image = small_image
 
-    print(f"Processing folder: '{celebrity_name}'")
+    # Detect faces (rows are x, y, w, h, landmarks..., score)
+    face_detector.setInputSize((detect_image.shape[1], detect_image.shape[0]))
+    _, detections = face_detector.detect(detect_image)
+    if detections is None:
+        detections = np.empty((0, 15), dtype=np.float32)
 
-    # Create corresponding output celebrity folder
-    if not os.path.exists(output_celebrity_dir):
-        os.makedirs(output_celebrity_dir)
+    # Map boxes back to the original resolution (reduced decode, then detection scale)
+    # and drop faces below the minimum size
+    faces = (detections[:, :4] * (decode_ratio / scale)).astype(np.int32)
+    faces = faces[(faces[:, 2] >= MIN_FACE_SIZE[0]) & (faces[:, 3] >= MIN_FACE_SIZE[1])]
 
-    # Iterate through each image file in the celebrity folder
-    for filename in os.listdir(input_celebrity_dir):
-        input_filepath = os.path.join(input_celebrity_dir, filename)
-        output_filepath = os.path.join(output_celebrity_dir, filename)
+    if len(faces) == 0:
+        # print(f"  Warning: No faces detected in {name}. Skipping.")
+        return 'no_face', None
 
-        # Basic check for image file extensions
-        if not filename.lower().endswith(('.png', '.jpg', '.jpeg', '.bmp', '.tiff')):
-            # print(f"  Skipping non-image file: {filename}")
-            continue
+    # Load the full-resolution image in color for cropping
+    image = cv2.imdecode(buf, cv2.IMREAD_COLOR)
+    if image is None:
+        print(f"  Warning: Could not read image: {name}. Skipping.")
+        return 'error', None
 
-        try:
-            # Load the image in color
-            image = cv2.imread(input_filepath)
-            if image is None:
-                print(f"  Warning: Could not read image: {input_filepath}. Skipping.")
-                error_count += 1
-                continue
+    img_h, img_w = image.shape[:2]
+
+    status = 'processed'
+
+    # Handle multiple faces: choose the largest one based on area (w*h)
+    if len(faces) > 1:
+        # print(f"  Warning: Multiple faces ({len(faces)}) detected in {name}. Cropping the largest.")
+        status = 'multi_face'
+        areas = faces[:, 2].astype(np.int64) * faces[:, 3]
+        largest = int(areas.argmax())
+        # Keep only the largest face
+        faces = faces[largest:largest + 1]
+
+
+    # Get coordinates of the (largest) detected face
+    (x, y, w, h) = (int(v) for v in faces[0])
+
+    # Calculate padding
+    pad_w = int(w * PADDING_FACTOR / 2)
+    pad_h = int(h * PADDING_FACTOR / 2)
+
+    # Calculate coordinates for cropping with padding, ensuring they stay within image bounds
+    crop_x1 = max(0, x - pad_w)
+    crop_y1 = max(0, y - pad_h)
+    crop_x2 = min(img_w, x + w + pad_w)
+    crop_y2 = min(img_h, y + h + pad_h)
+
+    # Crop the original color image
+    cropped_face = image[crop_y1:crop_y2, crop_x1:crop_x2]
+
+    # Check if crop is valid
+    if cropped_face.size == 0:
+        print(f"  Warning: Cropped face has zero size for {name}. Skipping.")
+        return 'error', None
+
+    # Resize the cropped face to the target size with high-quality interpolation
+    resized_face = cv2.resize(cropped_face, TARGET_SIZE, interpolation=cv2.INTER_AREA if (w*h > TARGET_SIZE[0]*TARGET_SIZE[1]) else cv2.INTER_CUBIC)
+    return status, resized_face
+
+
+def encode_face_jpeg(resized_face):
+    # Use libjpeg-turbo when available, otherwise OpenCV's encoder
+    if jpeg_encoder is not None:
+        return jpeg_encoder.encode(resized_face, quality=SAVE_JPEG_QUALITY)
+    _, encoded = cv2.imencode('.jpg', resized_face, [cv2.IMWRITE_JPEG_QUALITY, SAVE_JPEG_QUALITY])
+    return encoded.tobytes()
 
-            # Convert the image to grayscale for the detector
-            gray_image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-            img_h, img_w = image.shape[:2]
-
-            # Detect faces
-            faces = face_cascade.detectMultiScale(
-                gray_image,
-                scaleFactor=1.1,      # How much the image size is reduced at each image scale
-                minNeighbors=5,       # How many neighbors each candidate rectangle should have
-                minSize=MIN_FACE_SIZE # Minimum possible object size
-            )
-
-            if len(faces) == 0:
-                # print(f"  Warning: No faces detected in {filename}. Skipping.")
-                skipped_no_face += 1
-                continue
 
-            # Handle multiple faces: choose the largest one based on area (w*h)
-            if len(faces) > 1:
-                # print(f"  Warning: Multiple faces ({len(faces)}) detected in {filename}. Cropping the largest.")
-                skipped_multi_face +=1
-                faces = sorted(faces, key=lambda f: f[2]*f[3], reverse=True)
-                # Keep only the largest face
-                faces = [faces[0]]
+def crop_image_bytes(img_bytes):
+    """
+    Crops the largest face out of downloaded image bytes without touching the disk.
+    Returns (status, jpeg_bytes), with jpeg_bytes None unless a face was cropped.
+    """
+    if face_detector is None:
+        _init_worker()
+    status, resized_face = crop_face(np.frombuffer(img_bytes, dtype=np.uint8), "downloaded image")
+    if resized_face is None:
+        return status, None
+    return status, encode_face_jpeg(resized_face)
 
 
-            # Get coordinates of the (largest) detected face
-            (x, y, w, h) = faces[0]
+def process_one(input_filepath, output_filepath):
+    """
+    Detects the largest face in one image, crops it and saves it to output_filepath.
+    Returns status: 'processed', 'multi_face' (processed, largest face kept), 'no_face' or 'error'.
+    """
+    try:
+        # Read the file once and decode from memory
+        buf = np.fromfile(input_filepath, dtype=np.uint8)
+        status, resized_face = crop_face(buf, input_filepath)
+        if resized_face is None:
+            return status
 
-            # Calculate padding
-            pad_w = int(w * PADDING_FACTOR / 2)
-            pad_h = int(h * PADDING_FACTOR / 2)
+        # For JPEG, add quality parameter
+        if output_filepath.lower().endswith(('.jpg', '.jpeg')):
+            with open(output_filepath, "wb") as f:
+                f.write(encode_face_jpeg(resized_face))
+        else: 
+            cv2.imwrite(output_filepath, resized_face)
 
-            # Calculate coordinates for cropping with padding, ensuring they stay within image bounds
-            crop_x1 = max(0, x - pad_w)
-            crop_y1 = max(0, y - pad_h)
-            crop_x2 = min(img_w, x + w + pad_w)
-            crop_y2 = min(img_h, y + h + pad_h)
+        return status
 
-            # Crop the original color image
-            cropped_face = image[crop_y1:crop_y2, crop_x1:crop_x2]
+    except Exception as e:
+        print(f"  Error processing file {input_filepath}: {e}")
+        return 'error'
 
-            # Check if crop is valid
-            if cropped_face.size == 0:
-                print(f"  Warning: Cropped face has zero size for {filename}. Skipping.")
-                error_count += 1
+
+def main():
+    # Check if the face detector model exists
+    if not os.path.exists(FACE_DETECTOR_MODEL_PATH):
+        print(f"Error: Face detector model not found at '{FACE_DETECTOR_MODEL_PATH}'")
+        print("Please download it from the OpenCV Zoo repository (models/face_detection_yunet) and place it correctly.")
+        sys.exit(1)
+
+    # Make sure the face detector loads before starting the workers
+    try:
+        _create_detector()
+    except cv2.error as e:
+        print(f"Error: Could not load face detector from '{FACE_DETECTOR_MODEL_PATH}': {e}")
+        sys.exit(1)
+
+    # Check if input directory exists
+    if not os.path.isdir(INPUT_BASE_DIR):
+        print(f"Error: Input directory '{INPUT_BASE_DIR}' not found.")
+        sys.exit(1)
+
+    # Create the base output directory if it doesn't exist
+    if not os.path.exists(OUTPUT_BASE_DIR):
+        print(f"Creating output directory: '{OUTPUT_BASE_DIR}'")
+        os.makedirs(OUTPUT_BASE_DIR)
+
+    print("Starting face detection and cropping process...")
+    print(f"Input Directory:  {os.path.abspath(INPUT_BASE_DIR)}")
+    print(f"Output Directory: {os.path.abspath(OUTPUT_BASE_DIR)}")
+    print(f"Target Size:      {TARGET_SIZE}")
+    print("-" * 30)
+
+    # --- Collect (input, output) paths ---
+    input_paths = []
+    output_paths = []
+
+    # Iterate through each celebrity folder in the input directory
+    # (scandir's DirEntry caches the file type, so no extra stat per entry)
+    with os.scandir(INPUT_BASE_DIR) as celebrity_entries:
+        for celebrity_entry in celebrity_entries:
+            # Ensure it's actually a directory
+            if not celebrity_entry.is_dir():
                 continue
 
-            # Resize the cropped face to the target size with high-quality interpolation
-            resized_face = cv2.resize(cropped_face, TARGET_SIZE, interpolation=cv2.INTER_AREA if (w*h > TARGET_SIZE[0]*TARGET_SIZE[1]) else cv2.INTER_CUBIC)
-
-           
-            # For JPEG, add quality parameter
-            if output_filepath.lower().endswith(('.jpg', '.jpeg')):
-                 cv2.imwrite(output_filepath, resized_face, [cv2.IMWRITE_JPEG_QUALITY, SAVE_JPEG_QUALITY])
-            else: 
-                cv2.imwrite(output_filepath, resized_face)
-
-            processed_count += 1
-
-        except Exception as e:
-            print(f"  Error processing file {input_filepath}: {e}")
-            error_count += 1
-
-# --- Completion Summary ---
-print("-" * 30)
-print("Processing Complete.")
-print(f"Total images processed and saved: {processed_count}")
-print(f"Images skipped (no face detected): {skipped_no_face}")
-print(f"Images skipped (multiple faces detected, processed largest): {skipped_multi_face}")
-print(f"Errors encountered: {error_count}")
-print(f"Cropped images saved in: '{os.path.abspath(OUTPUT_BASE_DIR)}'")
\ No newline at end of file
+            celebrity_name = celebrity_entry.name
+            output_celebrity_dir = os.path.join(OUTPUT_BASE_DIR, celebrity_name) + os.sep
+
+            print(f"Collecting folder: '{celebrity_name}'")
+
+            # Create corresponding output celebrity folder
+            os.makedirs(output_celebrity_dir, exist_ok=True)
+
+            # Iterate through each image file in the celebrity folder
+            with os.scandir(celebrity_entry.path) as image_entries:
+                for image_entry in image_entries:
+                    filename = image_entry.name
+                    # Basic check for image file extensions
+                    if os.path.splitext(filename)[1].lower() not in VALID_EXTS:
+                        # print(f"  Skipping non-image file: {filename}")
+                        continue
+
+                    input_paths.append(image_entry.path)
+                    output_paths.append(output_celebrity_dir + filename)
+
+    print(f"Processing {len(input_paths)} images with {MAX_WORKERS} worker processes...")
+
+    # --- Processing ---
+    counters = Counter()
+    with ProcessPoolExecutor(max_workers=MAX_WORKERS, initializer=_init_worker) as executor:
+        for status in executor.map(process_one, input_paths, output_paths, chunksize=16):
+            counters[status] += 1
+
+    # --- Completion Summary ---
+    print("-" * 30)
+    print("Processing Complete.")
+    print(f"Total images processed and saved: {counters['processed'] + counters['multi_face']}")
+    print(f"Images skipped (no face detected): {counters['no_face']}")
+    print(f"Images skipped (multiple faces detected, processed largest): {counters['multi_face']}")
+    print(f"Errors encountered: {counters['error']}")
+    print(f"Cropped images saved in: '{os.path.abspath(OUTPUT_BASE_DIR)}'")
+
+
+if __name__ == "__main__":
+    main()